@@ -0,0 +1,131 @@
+import empyrical as ep
+import numpy as np
+import pandas as pd
+import pyfolio as pf
+
+from transactions import get_transactions
+from utils import serialize_series, serialize_regular_series
+
+
+def to_utc(df):
+    df.index = df.index.tz_localize('utc') if df.index.tz is None else df.index.tz_convert('utc')
+    return df
+
+
+def price_volume_matrices(market_data):
+    # one (time x symbol) matrix per field, aligned on the union of bar timestamps
+    price = pd.DataFrame({ticker: bars['c'] for ticker, bars in market_data.items()}).sort_index()
+    volume = pd.DataFrame({ticker: bars['v'] for ticker, bars in market_data.items()}).sort_index()
+    return to_utc(price), to_utc(volume)
+
+
+def get_days_to_liquidate(positions, price, volume, max_bar_consumption, capital_base, mean_volume_window):
+    daily_dollar_volume = (price * volume).resample('1D').sum(min_count=1).dropna(how='all')
+    roll_mean_dv = daily_dollar_volume.rolling(mean_volume_window).mean().shift().replace(0, np.nan)
+
+    positions_alloc = pf.pos.get_percent_alloc(positions).drop('cash', axis=1)
+    positions_alloc.index = positions_alloc.index.normalize()
+    max_liquidity = max_bar_consumption * roll_mean_dv.reindex(positions_alloc.index)
+
+    days_to_liquidate = (positions_alloc * capital_base).abs() / max_liquidity
+    days_to_liquidate = days_to_liquidate.replace([np.inf, -np.inf], np.nan).dropna(axis=1, how='all')
+    return days_to_liquidate, positions_alloc
+
+
+def get_max_days_to_liquidate_by_ticker(days_to_liquidate, positions_alloc):
+    max_days = days_to_liquidate.max()
+    max_dates = days_to_liquidate.idxmax()
+    rows = positions_alloc.index.get_indexer(max_dates)
+    cols = positions_alloc.columns.get_indexer(max_dates.index)
+    alloc_at_max = positions_alloc.values[rows, cols] * 100
+    df = pd.DataFrame({
+        'date': max_dates.values.astype('datetime64[ms]').astype(np.int64),
+        'days_to_liquidate': max_days.values,
+        'pos_alloc_pct': alloc_at_max,
+    }, index=max_days.index)
+    return df.sort_values('days_to_liquidate', ascending=False)
+
+
+def get_bar_consumption(transactions, volume):
+    # fraction of the bar's volume each fill consumed, looked up in the volume matrix without a join
+    rows = volume.index.get_indexer(transactions.index, method='pad')
+    cols = volume.columns.get_indexer(transactions.symbol)
+    valid = (rows >= 0) & (cols >= 0)
+    bar_volume = np.full(len(transactions), np.nan)
+    bar_volume[valid] = volume.values[rows[valid], cols[valid]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        consumption = np.abs(transactions.amount.values) / bar_volume
+    consumption[~np.isfinite(consumption)] = np.nan
+    return pd.Series(consumption, index=transactions.index)
+
+
+def get_round_trip_bar_consumption(round_trip, transactions, consumption):
+    trips = pd.DataFrame({
+        'symbol': round_trip['asset'].apply(lambda x: x['ticker']).values,
+        'open_dt': pd.to_datetime(round_trip['openDateTime'].values, utc=True),
+        'close_dt': pd.to_datetime(round_trip['closeDateTime'].values, utc=True),
+    })
+    trips = trips.sort_values('open_dt').reset_index(drop=True)
+    trips['trip'] = trips.index
+
+    fills = pd.DataFrame({
+        'symbol': transactions.symbol.values,
+        'dt': transactions.index,
+        'consumption': consumption.values,
+    }).sort_values('dt')
+
+    # each fill belongs to the latest trip of its symbol opened at or before it, if that trip is still open
+    matched = pd.merge_asof(fills, trips, left_on='dt', right_on='open_dt', by='symbol', direction='backward')
+    matched = matched[matched.dt <= matched.close_dt]
+
+    per_trip = matched.groupby('trip').consumption.max()
+    trips = trips.join(per_trip.rename('max_bar_consumption'), on='trip').dropna(subset=['max_bar_consumption'])
+    return trips
+
+
+def get_slippage_sweep(returns, positions, transactions, slippage_bps):
+    # same adjustment as pf.txn.adjust_returns_for_slippage, broadcast over every slippage level at once
+    portfolio_value = positions.sum(axis=1).reindex(returns.index)
+    traded_value = pf.txn.get_txn_vol(transactions).txn_volume.reindex(returns.index, fill_value=0)
+    slippage = np.asarray(slippage_bps, dtype=float) * 0.0001
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        turnover = (traded_value / portfolio_value).values
+    turnover[~np.isfinite(turnover)] = np.nan
+    adjusted = returns.values[:, None] - turnover[:, None] * slippage[None, :]
+
+    return pd.DataFrame({
+        'sharpe': ep.sharpe_ratio(adjusted),
+        'annual_return': ep.annual_return(adjusted) * 100,
+    }, index=slippage_bps)
+
+
+async def capacity_tear_sheet(market_data, positions, returns, orders, round_trip,
+                              max_bar_consumption, capital_base, mean_volume_window, slippage_bps):
+    result = {}
+    price, volume = price_volume_matrices(market_data)
+
+    days_to_liquidate, positions_alloc = get_days_to_liquidate(
+        positions, price, volume, max_bar_consumption, capital_base, mean_volume_window
+    )
+    result['max_days_to_liquidate'] = serialize_series(days_to_liquidate.max(axis=1))
+    result['days_to_liquidate_by_ticker'] = get_max_days_to_liquidate_by_ticker(
+        days_to_liquidate, positions_alloc).fillna(0).to_records().tolist()
+
+    transactions = get_transactions(orders)
+    consumption = get_bar_consumption(transactions, volume)
+    result['max_bar_consumption_by_ticker'] = serialize_regular_series(
+        (consumption.groupby(transactions.symbol.values).max() * 100).sort_values(ascending=False))
+
+    result['round_trip_bar_consumption'] = []
+    if round_trip is not None and len(round_trip) > 0:
+        trips = get_round_trip_bar_consumption(round_trip, transactions, consumption)
+        result['round_trip_bar_consumption'] = [
+            [symbol, int(open_dt.value // 1_000_000), int(close_dt.value // 1_000_000), value * 100]
+            for symbol, open_dt, close_dt, value in
+            trips[['symbol', 'open_dt', 'close_dt', 'max_bar_consumption']].itertuples(index=False)
+        ]
+
+    result['slippage_sweep'] = get_slippage_sweep(
+        returns, positions, transactions, slippage_bps).to_records().tolist()
+    return result
@@ -14,9 +14,7 @@ def make_positions(positions_res):
     replace_asset(positions_res)
     return positions_res.pivot_table(index='t', columns='asset', values='calculatedValue')
 
-def positions_tear_sheet(positions_res, asset_specs, cash, base_tf):
-    result = {}
-
+def get_positions(positions_res, cash, base_tf):
     pos_no_cash = make_positions(positions_res)
     positions = pd.concat([cash, pos_no_cash], axis=1, sort=True)
     if base_tf == '1T':
@@ -26,7 +24,12 @@ def positions_tear_sheet(positions_res, asset_specs, cash, base_tf):
         # Group by the normalized date and take the last entry for each group
         positions = positions.groupby(positions.index).last()
     positions.index = positions.index.tz_localize('utc')
+    return positions
+
+def positions_tear_sheet(positions_res, asset_specs, cash, base_tf):
+    result = {}
 
+    positions = get_positions(positions_res, cash, base_tf)
     positions_alloc = pf.pos.get_percent_alloc(positions)
 
     pos_no_cash = positions.drop("cash", axis=1)
@@ -0,0 +1,206 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CACHED = 'cached'
+
+
+class ResultCache:
+    # serialized tear sheets keyed by (campaign_id, sheet, *params), bounded by total body size and
+    # evicted least recently used first
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        body = self._entries.get(key)
+        if body is not None:
+            self._entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            logging.warning(f'Result for {key} is {len(body)} bytes, larger than the whole cache; not caching.')
+            return
+        self._remove(key)
+        self._entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _remove(self, key):
+        body = self._entries.pop(key, None)
+        if body is not None:
+            self.size -= len(body)
+
+    def invalidate(self, campaign_id):
+        for key in [key for key in self._entries if key[0] == campaign_id]:
+            self._remove(key)
+
+
+class Precomputer:
+    # jobs maps a step name to (key, build): key(campaign_id) is the cache key the step fills and
+    # build(campaign_id) returns its serialized body
+    def __init__(self, cache, jobs, workers, max_pending, history=1024):
+        self.cache = cache
+        self.jobs = jobs
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+
+        self._queue = asyncio.Queue()
+        self._status = OrderedDict()
+        self._pending = {}
+        self._running = set()
+        self._claims = {}
+        self._tasks = []
+
+    def _ensure_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def _trim_history(self):
+        for campaign_id in list(self._status):
+            if len(self._status) <= self.history:
+                break
+            if self._status[campaign_id]['status'] in (DONE, FAILED):
+                del self._status[campaign_id]
+
+    def _queued(self):
+        return sum(1 for status in self._status.values() if status['status'] == QUEUED)
+
+    def produces(self, key):
+        return any(job_key(key[0]) == key for job_key, _ in self.jobs.values())
+
+    def status(self, campaign_id=None):
+        if campaign_id is None:
+            return list(self._status.values())
+        return self._status.get(campaign_id)
+
+    def notify(self, campaign_id, force=False):
+        # repeated completion notifications are folded into the job already queued, running or done; a forced one
+        # on a running job cannot stop it, so it reruns the campaign once the current pass finishes
+        status = self._status.get(campaign_id)
+        if status is not None:
+            if status['status'] == QUEUED:
+                if force:
+                    self.cache.invalidate(campaign_id)
+                return status
+            if status['status'] == RUNNING:
+                status['rerun'] = status['rerun'] or force
+                return status
+            if status['status'] == DONE and not force:
+                return status
+
+        if self._queued() >= self.max_pending:
+            logging.warning(f'Precompute queue full, dropping notification for {campaign_id}.')
+            return None
+
+        if force:
+            self.cache.invalidate(campaign_id)
+        return self._schedule(campaign_id)
+
+    def _schedule(self, campaign_id):
+        self._status.pop(campaign_id, None)
+        self._status[campaign_id] = dict(
+            campaign_id=campaign_id,
+            status=QUEUED,
+            progress=0.0,
+            steps={name: QUEUED for name in self.jobs},
+            error=None,
+            queued_at=time.time(),
+            started_at=None,
+            finished_at=None,
+            rerun=False,
+        )
+        for job_key, _ in self.jobs.values():
+            self._pending[job_key(campaign_id)] = asyncio.Event()
+        self._trim_history()
+
+        self._ensure_workers()
+        self._queue.put_nowait(campaign_id)
+        return self._status[campaign_id]
+
+    async def get(self, key):
+        # only a step that is being built right now is worth waiting for; a queued one is cheaper to claim
+        body = self.cache.get(key)
+        if body is not None:
+            return body
+        if key in self._claims:
+            await self._claims[key].wait()
+        elif key in self._running:
+            await self._pending[key].wait()
+        else:
+            return None
+        return self.cache.get(key)
+
+    @contextlib.contextmanager
+    def claim(self, key):
+        # a request building a step that is still queued takes it over, so the worker finds it cached and waiters
+        # on the same key wait for the request instead of building it again
+        if key not in self._pending or key in self._running or key in self._claims:
+            yield
+            return
+        self._claims[key] = asyncio.Event()
+        try:
+            yield
+        finally:
+            self._claims.pop(key).set()
+
+    async def _work(self):
+        while True:
+            campaign_id = await self._queue.get()
+            try:
+                status = self._status[campaign_id]
+                await self._run(campaign_id, status)
+                if status['rerun']:
+                    # whatever this pass wrote may predate the data the forced notification was about
+                    self.cache.invalidate(campaign_id)
+                    self._schedule(campaign_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, campaign_id, status):
+        status['status'] = RUNNING
+        status['started_at'] = time.time()
+        errors = []
+        try:
+            for i, (name, (job_key, build)) in enumerate(self.jobs.items()):
+                key = job_key(campaign_id)
+                try:
+                    if key in self._claims:
+                        await self._claims[key].wait()
+                    if self.cache.get(key) is not None:
+                        status['steps'][name] = CACHED
+                        continue
+                    status['steps'][name] = RUNNING
+                    self._running.add(key)
+                    self.cache.put(key, await build(campaign_id))
+                    status['steps'][name] = DONE
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    error_msg = getattr(e, 'detail', None) or str(e)
+                    logging.error(f'Precompute of {name} for {campaign_id} failed: {error_msg}')
+                    status['steps'][name] = FAILED
+                    errors.append(f'{name}: {error_msg}')
+                finally:
+                    status['progress'] = (i + 1) / len(self.jobs)
+                    self._running.discard(key)
+                    self._pending.pop(key).set()
+            status['status'] = FAILED if errors else DONE
+            status['error'] = '; '.join(errors) or None
+        finally:
+            status['finished_at'] = time.time()
+            for job_key, _ in self.jobs.values():
+                event = self._pending.pop(job_key(campaign_id), None)
+                if event is not None:
+                    event.set()
@@ -0,0 +1,223 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+CLIENT_CLOSED_REQUEST = 499
+BARS_PER_DAY = {'1D': 1, '1T': 390}
+# rough size of one msgpack/JSON row as StratifyX sends it
+BYTES_PER_ROW = 100
+
+
+def estimate_cost(*frames):
+    # row counts of the fetched frames are a cheap proxy for the pandas memory/CPU a tear sheet needs
+    return sum(len(frame) for frame in frames if frame is not None)
+
+
+def estimate_period_cost(period, base_tf, frames):
+    # pre-fetch guess from the campaign period alone: one row per bar for every frame we are about to fetch
+    days = np.busday_count(pd.to_datetime(period['start']).date(), pd.to_datetime(period['end']).date()) + 1
+    return max(int(days), 1) * BARS_PER_DAY.get(base_tf, 1) * frames
+
+
+def estimate_bytes_cost(size):
+    return size // BYTES_PER_ROW
+
+
+class Ticket:
+    def __init__(self, weight):
+        self.weight = weight
+        self.future = None
+        self.fetched = 0
+
+
+class Scheduler:
+    def __init__(self, capacity, max_concurrency, max_queue, deadline, retry_after, poll_interval=0.25, aging=None):
+        self.capacity = capacity
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.poll_interval = poll_interval
+        # rows of priority a waiter gains per second; by default a full-budget request overtakes fresh
+        # single-row ones after a quarter of the deadline
+        self.aging = aging if aging is not None else 4 * capacity / deadline
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='analytics')
+        self._queue = []
+        self._counter = itertools.count()
+        self._waiting = set()
+        self._grower = None
+        self._used = 0
+        self._active = 0
+
+    def _weight(self, cost):
+        # anything bigger than the whole budget still runs, but alone
+        return min(max(int(cost), 1), self.capacity)
+
+    def _fits(self, weight):
+        return self._active < self.max_concurrency and self._used + weight <= self.capacity
+
+    def _release(self, weight):
+        self._used -= weight
+        self._active -= 1
+        self._wake()
+
+    def _grows(self, ticket, weight):
+        # a ticket that is the only one running may always grow, just like an oversized request runs alone
+        return self._active == 1 or self._used - ticket.weight + weight <= self.capacity
+
+    def _set_weight(self, ticket, weight):
+        self._used += weight - ticket.weight
+        ticket.weight = weight
+
+    def _wake(self):
+        # an admitted request waiting to grow goes first and holds back new admissions until it fits
+        if self._grower is not None:
+            ticket, weight, waiter = self._grower
+            if not waiter.done():
+                if not self._grows(ticket, weight):
+                    return
+                self._set_weight(ticket, weight)
+                waiter.set_result(None)
+        # strict head-of-line: once the head does not fit nobody behind it may overtake, so an aged large
+        # request drains the budget instead of being starved by a stream of small ones
+        while self._queue:
+            _, _, weight, waiter = self._queue[0]
+            if waiter.done():
+                heapq.heappop(self._queue)
+                continue
+            if not self._fits(weight):
+                break
+            heapq.heappop(self._queue)
+            self._used += weight
+            self._active += 1
+            waiter.set_result(None)
+
+    def _retry_headers(self):
+        return {'Retry-After': str(self.retry_after)}
+
+    async def _acquire(self, weight):
+        if len(self._waiting) >= self.max_queue:
+            logging.warning(f'Analytics queue full ({len(self._waiting)} waiting), rejecting request.')
+            raise HTTPException(status_code=503, detail="Server busy", headers=self._retry_headers())
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        # priority is weight - aging * waited; every waiter ages at the same rate, so
+        # weight + aging * enqueued_at orders the heap identically and never has to be re-keyed
+        priority = weight + self.aging * loop.time()
+        heapq.heappush(self._queue, (priority, next(self._counter), weight, waiter))
+        self._wake()
+
+        task = asyncio.current_task()
+        self._waiting.add(task)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # granted in the same tick we were cancelled
+                self._release(weight)
+            else:
+                self._wake()
+            raise
+        finally:
+            self._waiting.discard(task)
+
+    def _finish(self, future, weight):
+        self._release(weight)
+        if not future.cancelled() and future.exception() is not None:
+            logging.debug(f'Analytics computation failed: {future.exception()}')
+
+    @contextlib.asynccontextmanager
+    async def admit(self, cost):
+        # admission happens before the upstream fetches, so nothing is held in memory while queued
+        ticket = Ticket(self._weight(cost))
+        await self._acquire(ticket.weight)
+        try:
+            yield ticket
+        finally:
+            if ticket.future is None or ticket.future.done():
+                self._release(ticket.weight)
+            else:
+                # a running thread cannot be interrupted, so its weight is only returned once it really finishes
+                ticket.future.add_done_callback(lambda f: self._finish(f, ticket.weight))
+
+    async def grow(self, ticket, size):
+        # called with each response's Content-Length before it is read, so a campaign with many assets takes the
+        # weight its position/order frames really need before they are decoded rather than after
+        ticket.fetched += size or 0
+        weight = self._weight(estimate_bytes_cost(ticket.fetched))
+        if weight <= ticket.weight:
+            return
+        if self._grower is not None and self._grower[0] is ticket:
+            # another response of the same request is already waiting; it now waits for both
+            self._grower[1] = weight
+            waiter = self._grower[2]
+            self._wake()
+        elif self._grower is not None or self._grows(ticket, weight):
+            # only one request waits to grow at a time: two of them could each be waiting on the other's weight,
+            # so any other one overshoots like resize() does and holds back admissions instead
+            self._set_weight(ticket, weight)
+            return
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._grower = [ticket, weight, waiter]
+
+        try:
+            await waiter
+        finally:
+            if self._grower is not None and self._grower[2] is waiter:
+                self._grower = None
+                self._wake()
+
+    def resize(self, ticket, cost):
+        # swap the pre-fetch guess for the real row count; the frames are already in memory, so growing never
+        # waits, it only holds back admissions until the overshoot is released
+        self._set_weight(ticket, max(int(cost), 1))
+        self._wake()
+
+    async def run(self, ticket, compute, *args):
+        # the tear sheets are declared async but do blocking pandas work, so each one gets its own
+        # event loop on a worker thread and the server loop stays free to notice deadlines/disconnects
+        ticket.future = asyncio.get_running_loop().run_in_executor(self._executor, asyncio.run, compute(*args))
+        return await asyncio.shield(ticket.future)
+
+    async def _watch_disconnect(self, request):
+        while not await request.is_disconnected():
+            await asyncio.sleep(self.poll_interval)
+
+    async def serve(self, request, handler, *args):
+        work = asyncio.ensure_future(handler(*args))
+        watcher = asyncio.ensure_future(self._watch_disconnect(request))
+        try:
+            done, _ = await asyncio.wait({work, watcher}, timeout=self.deadline,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if work in done:
+                return work.result()
+
+            queued = work in self._waiting
+            work.cancel()
+            if watcher in done:
+                logging.info('Client disconnected, cancelled request.')
+                return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+            logging.warning(f'Request exceeded {self.deadline}s deadline while {"queued" if queued else "running"}.')
+            if queued:
+                raise HTTPException(status_code=503, detail="Server busy", headers=self._retry_headers())
+            raise HTTPException(status_code=504, detail="Deadline exceeded", headers=self._retry_headers())
+        finally:
+            watcher.cancel()
+            if not work.done():
+                work.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -8,17 +8,33 @@ import atexit
 import pyfolio as pf
 import utils
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 from interesting_periods import interesting_periods
-from positions import positions_tear_sheet
+from positions import get_positions, positions_tear_sheet
 from returns import returns_tear_sheet
 from transactions import txn_tear_sheets
 from round_trips import round_trips_tear_sheet
+from capacity import capacity_tear_sheet
+from scheduler import Scheduler, estimate_cost, estimate_period_cost
+from precompute import Precomputer, ResultCache
 import orjson
 
+DEFAULT_BENCHMARK = 'SPY'
+DEFAULT_TOP_DRAW_DOWNS = 5
+DEFAULT_ROLL_WINDOW = 6
+DEFAULT_TZ = "America/New_York"
+DEFAULT_BIN_MINUTES = 5
+DEFAULT_MAX_BAR_CONSUMPTION = 0.2
+DEFAULT_CAPITAL_BASE = 1e6
+DEFAULT_MEAN_VOLUME_WINDOW = 5
+DEFAULT_SLIPPAGE_BPS = (3.0, 8.0, 10.0, 12.0, 15.0, 20.0, 50.0)
+
 DEFAULT_ROUND_TRIPS = {
     "stats": {
         "columns": [],
@@ -47,11 +63,43 @@ DEFAULT_ROUND_TRIPS = {
 }
 
 
+def positive_int(value):
+    value = int(value)
+    if value <= 0:
+        raise ValueError(value)
+    return value
+
+
+def positive_float(value):
+    value = float(value)
+    if not value > 0:
+        raise ValueError(value)
+    return value
+
+
+def float_list(value):
+    return tuple(float(item) for item in value.split(','))
+
+
+def query_param(request, name, default, parse):
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        return parse(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: {value!r}")
+
+
+def serialize(content: typing.Any) -> bytes:
+    return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
 class ORJSONResponse(JSONResponse):
     media_type = "application/json"
 
     def render(self, content: typing.Any) -> bytes:
-        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+        return serialize(content)
 
 
 app = FastAPI(default_response_class=ORJSONResponse)
@@ -65,54 +113,54 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+scheduler = Scheduler(
+    capacity=int(os.environ.get('ANALYTICS_ROW_BUDGET', 2_000_000)),
+    max_concurrency=int(os.environ.get('ANALYTICS_MAX_CONCURRENCY', os.cpu_count() or 1)),
+    max_queue=int(os.environ.get('ANALYTICS_MAX_QUEUE', 64)),
+    deadline=float(os.environ.get('ANALYTICS_DEADLINE_SECONDS', 120)),
+    retry_after=int(os.environ.get('ANALYTICS_RETRY_AFTER_SECONDS', 10)),
+    aging=float(os.environ['ANALYTICS_AGING_ROWS_PER_SECOND']) if 'ANALYTICS_AGING_ROWS_PER_SECOND' in os.environ else None,
+)
+atexit.register(scheduler.shutdown)
 
-async def fetch_account(stratifyx_server_url, campaign_id):
-    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'account')
-
-
-async def fetch_factor_returns(period, benchmark):
-    return await utils.async_get_benchmark_returns(period, benchmark)
+# market data of several assets is parsed in worker processes; spawned, since the server already runs threads
+parse_processes = int(os.environ.get('ANALYTICS_PARSE_PROCESSES', os.cpu_count() or 1))
+parse_pool = ProcessPoolExecutor(parse_processes, mp_context=multiprocessing.get_context('spawn')) \
+    if parse_processes > 1 else None
+if parse_pool is not None:
+    atexit.register(parse_pool.shutdown, wait=False, cancel_futures=True)
 
+result_cache = ResultCache(max_bytes=int(os.environ.get('ANALYTICS_CACHE_BYTES', 512 * 1024 * 1024)))
 
-async def fetch_positions(stratifyx_server_url, campaign_id):
-    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'position')
 
+async def fetch_account(stratifyx_server_url, campaign_id, ticket):
+    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'account', partial(scheduler.grow, ticket))
 
-async def fetch_orders(stratifyx_server_url, campaign_id):
-    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'order')
 
+async def fetch_factor_returns(period, benchmark):
+    benchmark_url = os.environ.get('BENCHMARK_URL', 's3://epoch-db/DailyBars/Stocks/{benchmark}.parquet.gzip')
+    return await utils.async_get_benchmark_returns(period, benchmark, benchmark_url)
 
-async def fetch_round_trip(stratifyx_server_url, campaign_id):
-    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'round_trip')
 
+async def fetch_positions(stratifyx_server_url, campaign_id, ticket):
+    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'position', partial(scheduler.grow, ticket))
 
-@app.get("/{campaign_id}/returns")
-async def returns_and_periods(campaign_id: str, request: Request):
-    logging.debug(f'Received request for {campaign_id}')
 
-    benchmark = request.query_params.get('benchmark', 'SPY')
-    top_draw_downs = int(request.query_params.get('top_dd', 5))
-    roll_window = int(request.query_params.get('roll_window', 6))
+async def fetch_orders(stratifyx_server_url, campaign_id, ticket):
+    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'order', partial(scheduler.grow, ticket))
 
-    rolling_vol_rolling_window = pf.APPROX_BDAYS_PER_MONTH * roll_window
-    rolling_sharpe_rolling_window = pf.APPROX_BDAYS_PER_MONTH * roll_window
 
-    stratifyx_server_url = os.environ.get('STRATIFYX_SERVER_URL', "http://localhost:9001")
-    logging.debug(f'STRATIFYX_SERVER_URL: {stratifyx_server_url}')
+async def fetch_round_trip(stratifyx_server_url, campaign_id, ticket):
+    return await utils.async_parse_req(stratifyx_server_url, campaign_id, 'round_trip', partial(scheduler.grow, ticket))
 
-    campaign = await utils.async_get_campaign(stratifyx_server_url, campaign_id)
-    if not campaign:
-        logging.error('Campaign not found.')
-        raise HTTPException(status_code=404, detail="Campaign not found")
 
-    base_tf, campaign_config, error_msg = utils.load_campaign_config(campaign)
-    if error_msg:
-        logging.error(f"Unexpected error: {error_msg}")
-        raise HTTPException(status_code=500, detail=error_msg)
+async def fetch_market_data(stratifyx_server_url, campaign_id, base_tf, ticket):
+    return await utils.async_get_market_data_blobs(base_tf, stratifyx_server_url, campaign_id,
+                                                   partial(scheduler.grow, ticket))
 
-    factor_returns = await fetch_factor_returns(campaign_config['Period'], benchmark)
 
-    account = await fetch_account(stratifyx_server_url, campaign_id)
+async def compute_returns(account, base_tf, factor_returns, top_draw_downs,
+                          rolling_vol_rolling_window, rolling_sharpe_rolling_window):
     daily_returns = utils.get_returns(account, base_tf, factor_returns)
 
     future_returns = returns_tear_sheet(
@@ -122,18 +170,19 @@ async def returns_and_periods(campaign_id: str, request: Request):
 
     futures_interesting_periods = await interesting_periods(daily_returns, factor_returns)
 
-    return ORJSONResponse(content=dict(
+    return dict(
         returns=await future_returns,
         interesting_periods=futures_interesting_periods
-    ))
+    )
 
 
-@app.get("/{campaign_id}/analytics")
-async def analytics(campaign_id: str, request: Request):
-    logging.debug(f'Received request for {campaign_id}')
+def returns_key(campaign_id, benchmark, top_draw_downs, roll_window):
+    return campaign_id, 'returns', benchmark, top_draw_downs, roll_window
 
-    tz = request.query_params.get('tz', "America/New_York")
-    bin_minutes = int(request.query_params.get('bin_minutes', 5))
+
+async def build_returns(campaign_id, benchmark, top_draw_downs, roll_window):
+    rolling_vol_rolling_window = pf.APPROX_BDAYS_PER_MONTH * roll_window
+    rolling_sharpe_rolling_window = pf.APPROX_BDAYS_PER_MONTH * roll_window
 
     stratifyx_server_url = os.environ.get('STRATIFYX_SERVER_URL', "http://localhost:9001")
     logging.debug(f'STRATIFYX_SERVER_URL: {stratifyx_server_url}')
@@ -148,35 +197,249 @@ async def analytics(campaign_id: str, request: Request):
         logging.error(f"Unexpected error: {error_msg}")
         raise HTTPException(status_code=500, detail=error_msg)
 
-    positions_res = await fetch_positions(stratifyx_server_url, campaign_id)
-    account = await fetch_account(stratifyx_server_url, campaign_id)
+    async with scheduler.admit(estimate_period_cost(campaign_config['Period'], base_tf, 1)) as ticket:
+        factor_returns, account = await asyncio.gather(
+            fetch_factor_returns(campaign_config['Period'], benchmark),
+            fetch_account(stratifyx_server_url, campaign_id, ticket)
+        )
+        scheduler.resize(ticket, estimate_cost(account, factor_returns))
 
-    asset_specs, error_msg = await utils.async_get_asset_specs(positions_res['asset'], stratifyx_server_url)
-    if error_msg:
-        logging.error(f"Unexpected error: {error_msg}")
-        raise HTTPException(status_code=500, detail=error_msg)
+        return await scheduler.run(
+            ticket, compute_returns,
+            account, base_tf, factor_returns, top_draw_downs,
+            rolling_vol_rolling_window, rolling_sharpe_rolling_window
+        )
+
+
+@app.get("/{campaign_id}/returns")
+async def returns_and_periods(campaign_id: str, request: Request):
+    return await scheduler.serve(request, _returns_and_periods, campaign_id, request)
 
+
+async def _returns_and_periods(campaign_id: str, request: Request):
+    logging.debug(f'Received request for {campaign_id}')
+
+    benchmark = request.query_params.get('benchmark', DEFAULT_BENCHMARK)
+    top_draw_downs = query_param(request, 'top_dd', DEFAULT_TOP_DRAW_DOWNS, positive_int)
+    roll_window = query_param(request, 'roll_window', DEFAULT_ROLL_WINDOW, positive_int)
+
+    return await cached_response(
+        returns_key(campaign_id, benchmark, top_draw_downs, roll_window),
+        build_returns, campaign_id, benchmark, top_draw_downs, roll_window
+    )
+
+
+async def compute_analytics(positions_res, asset_specs, account, orders, round_trip, base_tf, bin_minutes, tz):
     cash = account['cashBalance'].to_frame('cash')
     position_result, position, sector_mappings = positions_tear_sheet(positions_res, asset_specs, cash, base_tf)
 
-    orders = await fetch_orders(stratifyx_server_url, campaign_id)
     futures_txn = txn_tear_sheets(orders, position, base_tf, bin_minutes, tz)
 
     daily_returns = utils.get_returns(account, base_tf, None)
-    round_trip = await fetch_round_trip(stratifyx_server_url, campaign_id)
 
     futures_round_trip = None
     if round_trip is not None:
         futures_round_trip = round_trips_tear_sheet(round_trip, daily_returns, position, sector_mappings)
 
-    content = dict(
+    return dict(
         position=position_result,
         txn=await futures_txn,
         round_trip=await futures_round_trip if round_trip is not None else DEFAULT_ROUND_TRIPS
     )
-    return ORJSONResponse(content=content)
 
 
+def analytics_key(campaign_id, tz, bin_minutes):
+    return campaign_id, 'analytics', tz, bin_minutes
+
+
+async def build_analytics(campaign_id, tz, bin_minutes):
+    stratifyx_server_url = os.environ.get('STRATIFYX_SERVER_URL', "http://localhost:9001")
+    logging.debug(f'STRATIFYX_SERVER_URL: {stratifyx_server_url}')
+
+    campaign = await utils.async_get_campaign(stratifyx_server_url, campaign_id)
+    if not campaign:
+        logging.error('Campaign not found.')
+        raise HTTPException(status_code=404, detail="Campaign not found")
+
+    base_tf, campaign_config, error_msg = utils.load_campaign_config(campaign)
+    if error_msg:
+        logging.error(f"Unexpected error: {error_msg}")
+        raise HTTPException(status_code=500, detail=error_msg)
+
+    async with scheduler.admit(estimate_period_cost(campaign_config['Period'], base_tf, 2)) as ticket:
+        positions_res, account, orders, round_trip = await asyncio.gather(
+            fetch_positions(stratifyx_server_url, campaign_id, ticket),
+            fetch_account(stratifyx_server_url, campaign_id, ticket),
+            fetch_orders(stratifyx_server_url, campaign_id, ticket),
+            fetch_round_trip(stratifyx_server_url, campaign_id, ticket)
+        )
+        scheduler.resize(ticket, estimate_cost(positions_res, account, orders, round_trip))
+
+        asset_specs, error_msg = await utils.async_get_asset_specs(positions_res['asset'], stratifyx_server_url)
+        if error_msg:
+            logging.error(f"Unexpected error: {error_msg}")
+            raise HTTPException(status_code=500, detail=error_msg)
+
+        return await scheduler.run(
+            ticket, compute_analytics,
+            positions_res, asset_specs, account, orders, round_trip, base_tf, bin_minutes, tz
+        )
+
+
+@app.get("/{campaign_id}/analytics")
+async def analytics(campaign_id: str, request: Request):
+    return await scheduler.serve(request, _analytics, campaign_id, request)
+
+
+async def _analytics(campaign_id: str, request: Request):
+    logging.debug(f'Received request for {campaign_id}')
+
+    tz = request.query_params.get('tz', DEFAULT_TZ)
+    bin_minutes = query_param(request, 'bin_minutes', DEFAULT_BIN_MINUTES, positive_int)
+
+    return await cached_response(
+        analytics_key(campaign_id, tz, bin_minutes),
+        build_analytics, campaign_id, tz, bin_minutes
+    )
+
+
+async def compute_capacity(market_data_blobs, positions_res, account, orders, round_trip, base_tf,
+                           max_bar_consumption, capital_base, mean_volume_window, slippage_bps):
+    # parsed here, on the admitted worker thread, so decoding counts against the scheduler's budget
+    market_data = utils.parse_market_data(market_data_blobs, parse_pool)
+    cash = account['cashBalance'].to_frame('cash')
+    positions = get_positions(positions_res, cash, base_tf)
+    daily_returns = utils.get_returns(account, base_tf, None)
+
+    return await capacity_tear_sheet(
+        market_data, positions, daily_returns, orders, round_trip,
+        max_bar_consumption, capital_base, mean_volume_window, slippage_bps
+    )
+
+
+async def build_capacity(campaign_id, max_bar_consumption, capital_base, mean_volume_window, slippage_bps):
+    stratifyx_server_url = os.environ.get('STRATIFYX_SERVER_URL', "http://localhost:9001")
+    logging.debug(f'STRATIFYX_SERVER_URL: {stratifyx_server_url}')
+
+    campaign = await utils.async_get_campaign(stratifyx_server_url, campaign_id)
+    if not campaign:
+        logging.error('Campaign not found.')
+        raise HTTPException(status_code=404, detail="Campaign not found")
+
+    base_tf, campaign_config, error_msg = utils.load_campaign_config(campaign)
+    if error_msg:
+        logging.error(f"Unexpected error: {error_msg}")
+        raise HTTPException(status_code=500, detail=error_msg)
+
+    async with scheduler.admit(estimate_period_cost(campaign_config['Period'], base_tf, 3)) as ticket:
+        market_data_blobs, positions_res, account, orders, round_trip = await asyncio.gather(
+            fetch_market_data(stratifyx_server_url, campaign_id, base_tf, ticket),
+            fetch_positions(stratifyx_server_url, campaign_id, ticket),
+            fetch_account(stratifyx_server_url, campaign_id, ticket),
+            fetch_orders(stratifyx_server_url, campaign_id, ticket),
+            fetch_round_trip(stratifyx_server_url, campaign_id, ticket)
+        )
+        # the fetch helpers log and return None when StratifyX fails, which is not the same as having no data
+        missing = [name for name, frame in (('market_data', market_data_blobs), ('position', positions_res),
+                                            ('account', account), ('order', orders)) if frame is None]
+        if missing:
+            logging.error(f'Failed to fetch {", ".join(missing)} for {campaign_id}.')
+            raise HTTPException(status_code=502, detail=f"Failed to fetch {', '.join(missing)}")
+        if not utils.market_data_rows(market_data_blobs):
+            logging.error('Market data not found.')
+            raise HTTPException(status_code=404, detail="Market data not found")
+        scheduler.resize(ticket, estimate_cost(positions_res, account, orders, round_trip)
+                         + utils.market_data_rows(market_data_blobs))
+
+        return await scheduler.run(
+            ticket, compute_capacity,
+            market_data_blobs, positions_res, account, orders, round_trip, base_tf,
+            max_bar_consumption, capital_base, mean_volume_window, slippage_bps
+        )
+
+
+@app.get("/{campaign_id}/capacity")
+async def capacity(campaign_id: str, request: Request):
+    return await scheduler.serve(request, _capacity, campaign_id, request)
+
+
+async def _capacity(campaign_id: str, request: Request):
+    logging.debug(f'Received request for {campaign_id}')
+
+    max_bar_consumption = query_param(request, 'max_bar_consumption', DEFAULT_MAX_BAR_CONSUMPTION, positive_float)
+    capital_base = query_param(request, 'capital_base', DEFAULT_CAPITAL_BASE, positive_float)
+    mean_volume_window = query_param(request, 'mean_volume_window', DEFAULT_MEAN_VOLUME_WINDOW, positive_int)
+    slippage_bps = query_param(request, 'slippage_bps', DEFAULT_SLIPPAGE_BPS, float_list)
+
+    # capacity depends on ad-hoc liquidity parameters and is never precomputed, so it neither waits on the
+    # precomputer nor goes through the result cache
+    return ORJSONResponse(content=await build_capacity(
+        campaign_id, max_bar_consumption, capital_base, mean_volume_window, slippage_bps
+    ))
+
+
+def default_returns_key(campaign_id):
+    return returns_key(campaign_id, DEFAULT_BENCHMARK, DEFAULT_TOP_DRAW_DOWNS, DEFAULT_ROLL_WINDOW)
+
+
+async def precompute_returns(campaign_id):
+    return serialize(await build_returns(campaign_id, DEFAULT_BENCHMARK, DEFAULT_TOP_DRAW_DOWNS, DEFAULT_ROLL_WINDOW))
+
+
+def default_analytics_key(campaign_id):
+    return analytics_key(campaign_id, DEFAULT_TZ, DEFAULT_BIN_MINUTES)
+
+
+async def precompute_analytics(campaign_id):
+    return serialize(await build_analytics(campaign_id, DEFAULT_TZ, DEFAULT_BIN_MINUTES))
+
+
+precomputer = Precomputer(
+    result_cache,
+    jobs=dict(
+        returns=(default_returns_key, precompute_returns),
+        analytics=(default_analytics_key, precompute_analytics),
+    ),
+    workers=int(os.environ.get('PRECOMPUTE_WORKERS', 2)),
+    max_pending=int(os.environ.get('PRECOMPUTE_MAX_PENDING', 256)),
+)
+
+
+async def cached_response(key, build, *args):
+    # only the default parameter sets the precomputer produces are cached; ad-hoc ones are built per request
+    if not precomputer.produces(key):
+        return ORJSONResponse(content=await build(*args))
+
+    body = await precomputer.get(key)
+    if body is None:
+        with precomputer.claim(key):
+            body = serialize(await build(*args))
+            result_cache.put(key, body)
+    return Response(content=body, media_type=ORJSONResponse.media_type)
+
+
+@app.post("/precompute/{campaign_id}")
+async def notify_campaign_completed(campaign_id: str, request: Request):
+    force = request.query_params.get('force', 'false').lower() == 'true'
+    status = precomputer.notify(campaign_id, force)
+    if status is None:
+        raise HTTPException(status_code=503, detail="Precompute queue full",
+                            headers={'Retry-After': str(scheduler.retry_after)})
+    return ORJSONResponse(content=status, status_code=202)
+
+
+@app.get("/precompute")
+async def precompute_status_all():
+    return ORJSONResponse(content=precomputer.status())
+
+
+@app.get("/precompute/{campaign_id}")
+async def precompute_status(campaign_id: str):
+    status = precomputer.status(campaign_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="No precompute job for campaign")
+    return ORJSONResponse(content=status)
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,68 @@
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import orjson
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+def make_blobs(assets, bars):
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2023-01-03 14:30', periods=bars, freq='min')
+    blobs = {}
+    for i in range(assets):
+        close = (100 * np.cumprod(1 + rng.normal(0, 1e-3, bars))).tolist()
+        volume = rng.integers(1, 100_000, bars).tolist()
+        blobs[f'A{i}'] = orjson.dumps([{'t': t.isoformat(), 'o': c, 'h': c * 1.001, 'l': c * 0.999, 'c': c, 'v': v}
+                                       for t, c, v in zip(index, close, volume)])
+    return blobs
+
+
+def read_json(blobs):
+    return {ticker: pd.read_json(io.BytesIO(blob), orient='records').set_index('t') for ticker, blob in blobs.items()}
+
+
+def best_of(repeat, parse, blobs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(blobs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the market data loader against pd.read_json.')
+    parser.add_argument('--assets', type=int, default=8)
+    parser.add_argument('--bars', type=int, default=100_000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    blobs = make_blobs(args.assets, args.bars)
+    print(f'{args.assets} assets x {args.bars} bars, {sum(map(len, blobs.values())) / 1e6:.0f} MB, '
+          f'{os.cpu_count()} cpus')
+
+    baseline = best_of(args.repeat, read_json, blobs)
+    print(f'pd.read_json            {baseline:7.2f}s')
+    inline = best_of(args.repeat, utils.parse_market_data, blobs)
+    print(f'parse_market_data       {inline:7.2f}s  {baseline / inline:.2f}x')
+
+    if args.processes > 1:
+        with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            utils.parse_market_data(blobs, pool)
+            pooled = best_of(args.repeat, lambda b: utils.parse_market_data(b, pool), blobs)
+        print(f'  with {args.processes} processes     {pooled:7.2f}s  {baseline / pooled:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import io
+
+import msgpack
+import numpy as np
+import orjson
+import pandas as pd
+import yaml
+from aiohttp import web
+
+START = '2023-01-02'
+END = '2023-06-30'
+ASSETS = [{'id': 'a1', 'ticker': 'AAPL'}, {'id': 'a2', 'ticker': 'MSFT'}]
+SECTORS = {'AAPL': 'Technology', 'MSFT': 'Software'}
+
+
+def _records(frame):
+    return msgpack.packb([{'t': t.isoformat(), 'data': data} for t, data in frame])
+
+
+def make_campaign(campaign_id):
+    rng = np.random.default_rng(7)
+    days = pd.bdate_range(START, END)
+
+    equity = 1e6 * np.cumprod(1 + rng.normal(0.0005, 0.01, len(days)))
+    cash = equity * 0.2
+    account = [(t, {'netLiquidationValue': e, 'cashBalance': c}) for t, e, c in zip(days, equity, cash)]
+
+    position = []
+    for t, e in zip(days, equity):
+        for asset, share in zip(ASSETS, (0.5, 0.3)):
+            position.append((t, {'marketValue': e * share, 'fxRate': 1.0, 'asset': asset}))
+
+    order, round_trip = [], []
+    for i in range(0, len(days) - 10, 10):
+        asset = ASSETS[(i // 10) % 2]
+        open_dt, close_dt = days[i], days[i + 5]
+        order.append((open_dt, {'filledQty': 100.0, 'side': 1, 'filledPrice': 100.0, 'asset': asset}))
+        order.append((close_dt, {'filledQty': 100.0, 'side': -1, 'filledPrice': 101.0 + i % 3, 'asset': asset}))
+        pnl = 100.0 * (1.0 + i % 3) * (1 if i % 20 else -1)
+        round_trip.append((close_dt, {'netReturn': pnl, 'openDateTime': open_dt.isoformat(),
+                                      'closeDateTime': close_dt.isoformat(), 'side': 1,
+                                      'returnPercent': pnl / 10000, 'asset': asset}))
+
+    market_data = []
+    for asset in ASSETS:
+        for timeframe, index in (('1D', days), ('1T', pd.date_range(START, periods=30, freq='min'))):
+            close = 100 * np.cumprod(1 + rng.normal(0, 0.01, len(index)))
+            bars = [{'t': t.isoformat(), 'o': c, 'h': c * 1.01, 'l': c * 0.99, 'c': c, 'v': int(v)}
+                    for t, c, v in zip(index, close.tolist(), rng.integers(5_000, 50_000, len(index)))]
+            market_data.append((index[0], {'asset': asset, 'timeframe': timeframe,
+                                           'dataBlob': orjson.dumps(bars).decode()}))
+
+    return {
+        'campaign': {'id': campaign_id, 'config': yaml.dump({
+            'SimpleBacktest': True, 'Period': {'start': START, 'end': END}})},
+        'account': _records(account),
+        'position': _records(position),
+        'order': _records(order),
+        'round_trip': _records(round_trip),
+        'market_data': _records(market_data),
+    }
+
+
+def make_benchmark():
+    rng = np.random.default_rng(11)
+    days = pd.bdate_range(START, END)
+    benchmark = pd.DataFrame({'c': 400 * np.cumprod(1 + rng.normal(0.0003, 0.01, len(days)))},
+                             index=pd.Index(days, name='t'))
+    buffer = io.BytesIO()
+    benchmark.to_parquet(buffer, engine='fastparquet')
+    return buffer.getvalue()
+
+
+class FakeStratifyX:
+    # serves just enough of the StratifyX API (plus a benchmark parquet) for the tear sheets to run
+    def __init__(self, campaign_ids):
+        self.campaigns = {campaign_id: make_campaign(campaign_id) for campaign_id in campaign_ids}
+        self.benchmark_parquet = make_benchmark()
+        self.hits = []
+        self.app = web.Application()
+        self.app.router.add_get('/campaign/{campaign_id}', self.campaign)
+        self.app.router.add_get('/reference/asset_specs/filter', self.asset_specs)
+        self.app.router.add_get('/benchmark/{benchmark}.parquet', self.benchmark)
+        self.app.router.add_get('/{campaign_id}/{key}', self.frame)
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def _campaign(self, request):
+        campaign = self.campaigns.get(request.match_info['campaign_id'])
+        if campaign is None:
+            raise web.HTTPNotFound()
+        return campaign
+
+    async def campaign(self, request):
+        self.hits.append(request.path)
+        return web.json_response(self._campaign(request)['campaign'])
+
+    async def frame(self, request):
+        self.hits.append(request.path)
+        body = self._campaign(request).get(request.match_info['key'])
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body, content_type='application/msgpack')
+
+    async def benchmark(self, request):
+        self.hits.append(request.path)
+        return web.Response(body=self.benchmark_parquet, content_type='application/octet-stream')
+
+    async def asset_specs(self, request):
+        self.hits.append(request.path)
+        return web.json_response([{'symbol': symbol, 'industry': industry} for symbol, industry in SECTORS.items()])
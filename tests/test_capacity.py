@@ -0,0 +1,103 @@
+import empyrical as ep
+import numpy as np
+import pandas as pd
+import pyfolio as pf
+from pandas.testing import assert_frame_equal
+
+from capacity import (get_bar_consumption, get_days_to_liquidate, get_round_trip_bar_consumption,
+                      get_slippage_sweep)
+
+DAYS = pd.date_range('2023-01-02', periods=30, freq='B', tz='utc')
+
+
+def make_positions():
+    rng = np.random.default_rng(3)
+    return pd.DataFrame({
+        'AAPL': rng.uniform(2e5, 4e5, len(DAYS)),
+        'MSFT': rng.uniform(1e5, 3e5, len(DAYS)),
+        'cash': rng.uniform(1e5, 2e5, len(DAYS)),
+    }, index=DAYS)
+
+
+def make_transactions(rows):
+    index = pd.DatetimeIndex([t for t, _, _, _ in rows])
+    return pd.DataFrame({'amount': [a for _, a, _, _ in rows], 'price': [p for _, _, p, _ in rows],
+                         'symbol': [s for _, _, _, s in rows]}, index=index)
+
+
+def test_bar_consumption_uses_the_bar_at_or_before_each_fill():
+    bars = pd.date_range('2024-01-02 14:30', periods=3, freq='min', tz='utc')
+    volume = pd.DataFrame({'AAPL': [1000.0, 200.0, 400.0], 'MSFT': [500.0, 500.0, 0.0]}, index=bars)
+    transactions = make_transactions([
+        (bars[1] + pd.Timedelta(seconds=30), -50, 10.0, 'AAPL'),
+        (bars[0] - pd.Timedelta(minutes=1), 10, 10.0, 'AAPL'),
+        (bars[2], 10, 10.0, 'XYZ'),
+        (bars[2], 10, 10.0, 'MSFT'),
+        (bars[2], 100, 10.0, 'AAPL'),
+    ])
+    consumption = get_bar_consumption(transactions, volume)
+    assert consumption.iloc[0] == 0.25
+    assert np.isnan(consumption.iloc[1])  # before the first bar
+    assert np.isnan(consumption.iloc[2])  # symbol without market data
+    assert np.isnan(consumption.iloc[3])  # zero-volume bar
+    assert consumption.iloc[4] == 0.25
+
+
+def test_round_trip_bar_consumption_matches_fills_to_open_trips():
+    d = DAYS
+    round_trip = pd.DataFrame({
+        'asset': [{'ticker': 'AAPL'}, {'ticker': 'AAPL'}, {'ticker': 'MSFT'}],
+        'openDateTime': [d[1].isoformat(), d[3].isoformat(), d[1].isoformat()],
+        'closeDateTime': [d[5].isoformat(), d[8].isoformat(), d[2].isoformat()],
+    })
+    transactions = make_transactions([
+        (d[1], 10, 1.0, 'AAPL'),
+        (d[4], 10, 1.0, 'AAPL'),
+        (d[5], 10, 1.0, 'AAPL'),
+        (d[8], 10, 1.0, 'AAPL'),
+        (d[1], 10, 1.0, 'MSFT'),
+        (d[4], 10, 1.0, 'MSFT'),
+    ])
+    consumption = pd.Series([0.1, 0.4, 0.2, 0.3, 0.05, 0.9], index=transactions.index)
+    trips = get_round_trip_bar_consumption(round_trip, transactions, consumption)
+
+    by_trip = {(row.symbol, row.open_dt): row.max_bar_consumption for row in trips.itertuples()}
+    # overlapping AAPL trips: each fill goes to the latest trip opened at or before it
+    assert by_trip[('AAPL', d[1])] == 0.1
+    assert by_trip[('AAPL', d[3])] == 0.4
+    # the MSFT fill after close_dt belongs to no trip
+    assert by_trip[('MSFT', d[1])] == 0.05
+    assert len(trips) == 3
+
+
+def test_slippage_sweep_matches_pyfolio():
+    rng = np.random.default_rng(5)
+    returns = pd.Series(rng.normal(0.001, 0.01, len(DAYS)), index=DAYS, name='returns')
+    positions = make_positions()
+    transactions = make_transactions([
+        (DAYS[i] + pd.Timedelta(hours=15), float(rng.integers(-500, 500)), 100.0, 'AAPL') for i in range(0, 30, 2)
+    ])
+    slippage_bps = (0.0, 2.5, 10.0, 50.0)
+    sweep = get_slippage_sweep(returns, positions, transactions, slippage_bps)
+
+    for bps in slippage_bps:
+        adjusted = pf.txn.adjust_returns_for_slippage(returns, positions, transactions, bps)
+        np.testing.assert_allclose(sweep.loc[bps, 'sharpe'], ep.sharpe_ratio(adjusted))
+        np.testing.assert_allclose(sweep.loc[bps, 'annual_return'], ep.annual_return(adjusted) * 100)
+
+
+def test_days_to_liquidate_matches_pyfolio():
+    rng = np.random.default_rng(9)
+    price = pd.DataFrame({'AAPL': rng.uniform(90, 110, len(DAYS)), 'MSFT': rng.uniform(190, 210, len(DAYS))},
+                         index=DAYS)
+    volume = pd.DataFrame({'AAPL': rng.uniform(1e4, 5e4, len(DAYS)), 'MSFT': rng.uniform(1e4, 5e4, len(DAYS))},
+                          index=DAYS)
+    positions = make_positions()
+    market_data = pd.concat([price, volume], keys=['price', 'volume']).swaplevel(0, 1).sort_index()
+
+    expected = pf.capacity.days_to_liquidate_positions(positions, market_data, max_bar_consumption=0.2,
+                                                       capital_base=1e6, mean_volume_window=5)
+    days_to_liquidate, _ = get_days_to_liquidate(positions, price, volume, 0.2, 1e6, 5)
+
+    assert_frame_equal(days_to_liquidate.iloc[5:], expected, check_freq=False, check_names=False)
+    assert days_to_liquidate.iloc[:5].isna().all().all()
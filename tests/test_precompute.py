@@ -0,0 +1,174 @@
+import asyncio
+
+from precompute import CACHED, DONE, QUEUED, RUNNING, Precomputer, ResultCache
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = ResultCache(max_bytes=10)
+    cache.put(('a', 'returns'), b'1234')
+    cache.put(('b', 'returns'), b'5678')
+    cache.get(('a', 'returns'))
+    cache.put(('c', 'returns'), b'90ab')
+    assert cache.get(('b', 'returns')) is None
+    assert cache.get(('a', 'returns')) == b'1234'
+    assert cache.size == 8
+
+    cache.put(('d', 'returns'), b'x' * 11)
+    assert cache.get(('d', 'returns')) is None
+
+    cache.put(('a', 'analytics'), b'12')
+    cache.invalidate('a')
+    assert cache.get(('a', 'returns')) is None and cache.size == 4
+
+
+class Jobs:
+    def __init__(self):
+        self.calls = []
+        self.gates = {'returns': asyncio.Event(), 'analytics': asyncio.Event()}
+
+    def job(self, name):
+        async def build(campaign_id):
+            self.calls.append((campaign_id, name))
+            await self.gates[name].wait()
+            return f'{campaign_id}:{name}'.encode()
+        return (lambda campaign_id: (campaign_id, name)), build
+
+
+def make_precomputer(jobs, workers=1):
+    return Precomputer(ResultCache(max_bytes=1024),
+                       jobs=dict(returns=jobs.job('returns'), analytics=jobs.job('analytics')),
+                       workers=workers, max_pending=4)
+
+
+def test_repeated_notifications_are_deduplicated():
+    async def main():
+        jobs = Jobs()
+        precomputer = make_precomputer(jobs)
+        first = precomputer.notify('c1')
+        assert precomputer.notify('c1') is first
+        for gate in jobs.gates.values():
+            gate.set()
+        await precomputer._queue.join()
+        assert precomputer.status('c1')['status'] == DONE
+        assert precomputer.notify('c1')['status'] == DONE
+        assert jobs.calls == [('c1', 'returns'), ('c1', 'analytics')]
+
+        precomputer.notify('c1', force=True)
+        await precomputer._queue.join()
+        assert len(jobs.calls) == 4
+
+    asyncio.run(main())
+
+
+def test_request_waits_for_its_own_step_only():
+    async def main():
+        jobs = Jobs()
+        precomputer = make_precomputer(jobs)
+        precomputer.notify('c1')
+        await asyncio.sleep(0)
+        request = asyncio.ensure_future(precomputer.get(('c1', 'returns')))
+        await asyncio.sleep(0)
+        assert not request.done()
+
+        jobs.gates['returns'].set()
+        assert await request == b'c1:returns'
+        assert precomputer.status('c1')['steps']['analytics'] != DONE
+        jobs.gates['analytics'].set()
+        await precomputer._queue.join()
+
+    asyncio.run(main())
+
+
+def test_request_for_queued_step_claims_it():
+    async def main():
+        jobs = Jobs()
+        precomputer = make_precomputer(jobs)
+        precomputer.notify('c1')
+        precomputer.notify('c2')
+        await asyncio.sleep(0)
+        assert precomputer.status('c2')['status'] == QUEUED
+
+        # the worker is busy with c1, so the request does not wait for it and builds c2 itself
+        key = ('c2', 'returns')
+        assert await precomputer.get(key) is None
+        with precomputer.claim(key):
+            waiter = asyncio.ensure_future(precomputer.get(key))
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            precomputer.cache.put(key, b'from a request')
+        assert await waiter == b'from a request'
+
+        for gate in jobs.gates.values():
+            gate.set()
+        await precomputer._queue.join()
+        assert precomputer.status('c2')['steps']['returns'] == CACHED
+        assert ('c2', 'returns') not in jobs.calls
+        assert precomputer.cache.get(key) == b'from a request'
+
+    asyncio.run(main())
+
+
+def test_worker_waits_for_a_claim_in_progress():
+    async def main():
+        jobs = Jobs()
+        precomputer = make_precomputer(jobs)
+        precomputer.notify('c1')
+        key = ('c1', 'returns')
+        with precomputer.claim(key):
+            await asyncio.sleep(0)
+            assert jobs.calls == []
+            assert precomputer.status('c1')['steps']['returns'] == QUEUED
+
+        # the claim failed without caching anything, so the worker builds the step after all
+        for gate in jobs.gates.values():
+            gate.set()
+        await precomputer._queue.join()
+        assert precomputer.status('c1')['steps']['returns'] == DONE
+        assert jobs.calls == [('c1', 'returns'), ('c1', 'analytics')]
+
+    asyncio.run(main())
+
+
+def test_worker_skips_keys_already_cached():
+    async def main():
+        jobs = Jobs()
+        precomputer = make_precomputer(jobs)
+        precomputer.cache.put(('c1', 'returns'), b'from a request')
+        for gate in jobs.gates.values():
+            gate.set()
+        precomputer.notify('c1')
+        await precomputer._queue.join()
+        assert jobs.calls == [('c1', 'analytics')]
+        assert precomputer.status('c1')['steps']['returns'] == CACHED
+        assert precomputer.cache.get(('c1', 'returns')) == b'from a request'
+
+    asyncio.run(main())
+
+
+def test_produces_only_default_keys():
+    jobs = Jobs()
+    precomputer = make_precomputer(jobs)
+    assert precomputer.produces(('c1', 'returns'))
+    assert not precomputer.produces(('c1', 'capacity'))
+
+
+def test_force_while_running_reruns_after_the_current_pass():
+    async def main():
+        jobs = Jobs()
+        precomputer = make_precomputer(jobs)
+        precomputer.notify('c1')
+        await asyncio.sleep(0)
+        assert precomputer.status('c1')['status'] == RUNNING
+
+        assert precomputer.notify('c1', force=True)['rerun']
+        jobs.gates['returns'].set()
+        await asyncio.sleep(0)
+        assert precomputer.cache.get(('c1', 'returns')) == b'c1:returns'
+
+        jobs.gates['analytics'].set()
+        await precomputer._queue.join()
+        assert precomputer.status('c1')['status'] == DONE
+        assert not precomputer.status('c1')['rerun']
+        assert jobs.calls == [('c1', 'returns'), ('c1', 'analytics')] * 2
+
+    asyncio.run(main())
@@ -0,0 +1,320 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from scheduler import CLIENT_CLOSED_REQUEST, Scheduler, estimate_period_cost
+
+
+class FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def make_scheduler(**kwargs):
+    params = dict(capacity=10, max_concurrency=10, max_queue=8, deadline=0.2, retry_after=7,
+                  poll_interval=0.01, aging=0)
+    params.update(kwargs)
+    return Scheduler(**params)
+
+
+async def compute(value):
+    return value
+
+
+async def admitted(scheduler, cost, order, name):
+    async with scheduler.admit(cost):
+        order.append(name)
+
+
+def test_small_request_not_stuck_behind_large():
+    async def main():
+        scheduler = make_scheduler()
+        order = []
+        async with scheduler.admit(5):
+            large = asyncio.ensure_future(admitted(scheduler, 8, order, 'large'))
+            await asyncio.sleep(0)
+            small = asyncio.ensure_future(admitted(scheduler, 2, order, 'small'))
+            await asyncio.sleep(0)
+            assert order == ['small']
+        await asyncio.gather(large, small)
+        assert order == ['small', 'large']
+        assert scheduler._used == 0 and scheduler._active == 0
+
+    asyncio.run(main())
+
+
+def test_aged_large_request_blocks_newer_small_ones():
+    async def main():
+        scheduler = make_scheduler(aging=1000)
+        order = []
+        async with scheduler.admit(5):
+            large = asyncio.ensure_future(admitted(scheduler, 8, order, 'large'))
+            await asyncio.sleep(0.05)
+            small = asyncio.ensure_future(admitted(scheduler, 2, order, 'small'))
+            await asyncio.sleep(0)
+            assert order == []
+        await asyncio.gather(large, small)
+        assert order == ['large', 'small']
+
+    asyncio.run(main())
+
+
+def test_cancel_while_queued_frees_the_queue():
+    async def main():
+        scheduler = make_scheduler()
+        order = []
+        async with scheduler.admit(10):
+            cancelled = asyncio.ensure_future(admitted(scheduler, 5, order, 'cancelled'))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            later = asyncio.ensure_future(admitted(scheduler, 5, order, 'later'))
+        await later
+        assert order == ['later']
+        assert scheduler._used == 0 and scheduler._active == 0 and not scheduler._waiting
+
+    asyncio.run(main())
+
+
+def test_cancel_in_the_same_tick_as_grant_releases_weight():
+    async def main():
+        scheduler = make_scheduler()
+        order = []
+        async with scheduler.admit(10):
+            waiter = asyncio.ensure_future(admitted(scheduler, 5, order, 'waiter'))
+            await asyncio.sleep(0)
+        # the release above granted the waiter, which has not resumed yet
+        assert scheduler._used == 5
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert order == []
+        assert scheduler._used == 0 and scheduler._active == 0
+
+    asyncio.run(main())
+
+
+def test_resize_tracks_real_rows():
+    async def main():
+        scheduler = make_scheduler()
+        async with scheduler.admit(2) as ticket:
+            scheduler.resize(ticket, 14)
+            assert scheduler._used == 14
+            blocked = asyncio.ensure_future(scheduler.admit(1).__aenter__())
+            await asyncio.sleep(0)
+            assert not blocked.done()
+            scheduler.resize(ticket, 3)
+            await blocked
+            assert scheduler._used == 4
+        assert scheduler._used == 1
+
+    asyncio.run(main())
+
+
+def test_grow_waits_for_room_before_decoding():
+    async def main():
+        scheduler = make_scheduler()
+        order = []
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.admit(5):
+                await release.wait()
+
+        held = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        async with scheduler.admit(2) as ticket:
+            grown = asyncio.ensure_future(scheduler.grow(ticket, 800))
+            await asyncio.sleep(0)
+            assert not grown.done()
+            # a request admitted later may not take the room the grower is waiting for
+            late = asyncio.ensure_future(admitted(scheduler, 1, order, 'late'))
+            await asyncio.sleep(0)
+            assert order == []
+
+            release.set()
+            await grown
+            assert ticket.weight == 8 and scheduler._used == 8
+            await late
+            assert order == ['late']
+        await held
+        assert scheduler._used == 0 and scheduler._active == 0
+
+    asyncio.run(main())
+
+
+def test_only_one_request_waits_to_grow():
+    async def main():
+        scheduler = make_scheduler()
+        async with scheduler.admit(4) as first, scheduler.admit(4) as second:
+            waiting = asyncio.ensure_future(scheduler.grow(first, 700))
+            await asyncio.sleep(0)
+            # waiting for each other would deadlock, so the second one overshoots instead
+            await scheduler.grow(second, 500)
+            assert second.weight == 5 and scheduler._used == 9
+
+            # another response of the same request raises the target it is already waiting for
+            joined = asyncio.ensure_future(scheduler.grow(first, 200))
+            await asyncio.sleep(0)
+            assert not waiting.done() and not joined.done()
+            scheduler.resize(second, 1)
+            await asyncio.gather(waiting, joined)
+            assert first.weight == 9 and scheduler._used == 10
+
+    asyncio.run(main())
+
+
+def test_lone_request_grows_up_to_the_whole_budget():
+    async def main():
+        scheduler = make_scheduler()
+        async with scheduler.admit(1) as ticket:
+            await scheduler.grow(ticket, 5000)
+            assert ticket.weight == 10
+            await scheduler.grow(ticket, None)
+            assert ticket.weight == 10
+
+    asyncio.run(main())
+
+
+def test_running_computation_keeps_weight_until_it_finishes():
+    async def main():
+        scheduler = make_scheduler()
+        release = threading.Event()
+
+        async def blocking():
+            release.wait()
+            return 'done'
+
+        async def handler():
+            async with scheduler.admit(6) as ticket:
+                return await scheduler.run(ticket, blocking)
+
+        task = asyncio.ensure_future(handler())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler._used == 6 and scheduler._active == 1
+
+        release.set()
+        for _ in range(100):
+            if scheduler._used == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert scheduler._used == 0 and scheduler._active == 0
+        scheduler.shutdown()
+
+    asyncio.run(main())
+
+
+def test_serve_returns_handler_result():
+    async def main():
+        scheduler = make_scheduler()
+
+        async def handler(value):
+            async with scheduler.admit(1) as ticket:
+                return await scheduler.run(ticket, compute, value)
+
+        assert await scheduler.serve(FakeRequest(), handler, 42) == 42
+        scheduler.shutdown()
+
+    asyncio.run(main())
+
+
+def test_serve_503_when_deadline_expires_while_queued():
+    async def main():
+        scheduler = make_scheduler()
+
+        async def handler():
+            async with scheduler.admit(5):
+                return 'never'
+
+        async with scheduler.admit(10):
+            with pytest.raises(HTTPException) as e:
+                await scheduler.serve(FakeRequest(), handler)
+        assert e.value.status_code == 503
+        assert e.value.headers == {'Retry-After': '7'}
+        await asyncio.sleep(0)
+        assert scheduler._used == 0 and not scheduler._waiting
+
+    asyncio.run(main())
+
+
+def test_serve_504_when_deadline_expires_while_running():
+    async def main():
+        scheduler = make_scheduler()
+        cancelled = asyncio.Event()
+
+        async def handler():
+            async with scheduler.admit(5):
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+        with pytest.raises(HTTPException) as e:
+            await scheduler.serve(FakeRequest(), handler)
+        assert e.value.status_code == 504
+        assert e.value.headers == {'Retry-After': '7'}
+        await asyncio.sleep(0)
+        assert cancelled.is_set()
+        assert scheduler._used == 0
+
+    asyncio.run(main())
+
+
+def test_serve_499_and_cancels_fetch_on_disconnect():
+    async def main():
+        scheduler = make_scheduler(deadline=5)
+        request = FakeRequest()
+        cancelled = asyncio.Event()
+
+        async def handler():
+            async with scheduler.admit(5):
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+        async def disconnect():
+            await asyncio.sleep(0.05)
+            request.disconnected = True
+
+        asyncio.ensure_future(disconnect())
+        response = await scheduler.serve(request, handler)
+        assert response.status_code == CLIENT_CLOSED_REQUEST
+        await asyncio.sleep(0)
+        assert cancelled.is_set()
+        assert scheduler._used == 0
+
+    asyncio.run(main())
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        scheduler = make_scheduler(max_queue=1)
+        order = []
+        async with scheduler.admit(10):
+            queued = asyncio.ensure_future(admitted(scheduler, 5, order, 'queued'))
+            await asyncio.sleep(0)
+            with pytest.raises(HTTPException) as e:
+                await admitted(scheduler, 5, order, 'rejected')
+            assert e.value.status_code == 503
+        await queued
+        assert order == ['queued']
+
+    asyncio.run(main())
+
+
+def test_estimate_period_cost():
+    period = {'start': '2024-01-01', 'end': '2024-01-05'}
+    assert estimate_period_cost(period, '1D', 2) == 10
+    assert estimate_period_cost(period, '1T', 1) == 5 * 390
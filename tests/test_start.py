@@ -0,0 +1,174 @@
+import asyncio
+
+import httpx
+import msgpack
+import pytest
+
+import start
+from fake_stratifyx import END, START, FakeStratifyX
+from precompute import DONE, Precomputer, ResultCache
+from scheduler import Scheduler, estimate_period_cost
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # fresh cache and worker pool per test, since every test runs on its own event loop
+    result_cache = ResultCache(max_bytes=64 * 1024 * 1024)
+    precomputer = Precomputer(result_cache, jobs=start.precomputer.jobs, workers=2, max_pending=8)
+    monkeypatch.setattr(start, 'result_cache', result_cache)
+    monkeypatch.setattr(start, 'precomputer', precomputer)
+    return start.app
+
+
+def run_against_fake(monkeypatch, campaign_ids, scenario):
+    async def main():
+        fake = await FakeStratifyX(campaign_ids).start()
+        monkeypatch.setenv('STRATIFYX_SERVER_URL', fake.url)
+        monkeypatch.setenv('BENCHMARK_URL', fake.url + '/benchmark/{benchmark}.parquet')
+        try:
+            transport = httpx.ASGITransport(app=start.app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://analytics') as client:
+                await scenario(client, fake)
+        finally:
+            await fake.stop()
+
+    asyncio.run(main())
+
+
+async def wait_until_finished(client, campaign_id):
+    for _ in range(200):
+        status = (await client.get(f'/precompute/{campaign_id}')).json()
+        if status['status'] not in ('queued', 'running'):
+            return status
+        await asyncio.sleep(0.05)
+    raise AssertionError(f'precompute of {campaign_id} did not finish: {status}')
+
+
+def test_precompute_serves_first_request_from_cache(app, monkeypatch):
+    async def scenario(client, fake):
+        response = await client.post('/precompute/c1')
+        assert response.status_code == 202
+        assert (await client.post('/precompute/c1')).json()['queued_at'] == response.json()['queued_at']
+
+        status = await wait_until_finished(client, 'c1')
+        assert status['status'] == DONE, status
+        assert status['progress'] == 1.0
+        assert status['steps'] == {'returns': DONE, 'analytics': DONE}
+
+        upstream_hits = len(fake.hits)
+        returns = await client.get('/c1/returns')
+        analytics = await client.get('/c1/analytics')
+        assert returns.status_code == 200 and analytics.status_code == 200
+        assert len(fake.hits) == upstream_hits
+
+        assert returns.content == start.result_cache.get(start.default_returns_key('c1'))
+        assert analytics.content == start.result_cache.get(start.default_analytics_key('c1'))
+        assert set(returns.json()) == {'returns', 'interesting_periods'}
+        assert set(analytics.json()) == {'position', 'txn', 'round_trip'}
+
+    run_against_fake(monkeypatch, ['c1'], scenario)
+
+
+def test_unknown_campaign_fails_precompute(app, monkeypatch):
+    async def scenario(client, fake):
+        await client.post('/precompute/missing')
+        status = await wait_until_finished(client, 'missing')
+        assert status['status'] == 'failed'
+        assert 'Campaign not found' in status['error']
+        assert (await client.get('/precompute/other')).status_code == 404
+
+    run_against_fake(monkeypatch, ['c1'], scenario)
+
+
+def test_multi_asset_campaign_is_weighed_before_decoding(app, monkeypatch):
+    # the fake campaign holds two assets, so its position frame has twice the rows the period estimate assumes
+    scheduler = Scheduler(capacity=10_000, max_concurrency=2, max_queue=8, deadline=30, retry_after=1)
+    monkeypatch.setattr(start, 'scheduler', scheduler)
+    weighed = []
+    resize = scheduler.resize
+
+    def record(ticket, cost):
+        weighed.append((ticket.weight, cost))
+        resize(ticket, cost)
+    monkeypatch.setattr(scheduler, 'resize', record)
+
+    async def scenario(client, fake):
+        response = await client.get('/c1/analytics')
+        assert response.status_code == 200, response.text
+
+    run_against_fake(monkeypatch, ['c1'], scenario)
+    scheduler.shutdown()
+
+    [(before_decoding, rows)] = weighed
+    guess = estimate_period_cost({'start': START, 'end': END}, '1D', 2)
+    assert guess < before_decoding <= scheduler.capacity
+    assert rows > guess and before_decoding >= 0.8 * rows
+    assert scheduler._used == 0 and scheduler._active == 0
+
+
+@pytest.mark.parametrize('path', [
+    '/c1/capacity?slippage_bps=2.5,abc',
+    '/c1/capacity?mean_volume_window=0',
+    '/c1/capacity?max_bar_consumption=-1',
+    '/c1/returns?top_dd=five',
+    '/c1/analytics?bin_minutes=1.5',
+])
+def test_bad_query_parameters_are_rejected(app, monkeypatch, path):
+    async def scenario(client, fake):
+        response = await client.get(path)
+        assert response.status_code == 400
+        assert 'Invalid' in response.json()['detail']
+        assert fake.hits == []
+
+    run_against_fake(monkeypatch, ['c1'], scenario)
+
+
+def test_capacity_accepts_fractional_slippage(app, monkeypatch):
+    async def scenario(client, fake):
+        response = await client.get('/c1/capacity?slippage_bps=0,2.5,10')
+        assert response.status_code == 200, response.text
+        assert [row[0] for row in response.json()['slippage_sweep']] == [0, 2.5, 10]
+
+    run_against_fake(monkeypatch, ['c1'], scenario)
+
+
+def test_capacity_reports_upstream_failures_apart_from_missing_data(app, monkeypatch):
+    async def scenario(client, fake):
+        del fake.campaigns['c1']['order']
+        response = await client.get('/c1/capacity')
+        assert response.status_code == 502 and response.json()['detail'] == 'Failed to fetch order'
+
+        fake.campaigns['c2']['market_data'] = b'\xc1'
+        response = await client.get('/c2/capacity')
+        assert response.status_code == 502 and response.json()['detail'] == 'Failed to fetch market_data'
+
+        fake.campaigns['c3']['market_data'] = msgpack.packb([])
+        assert (await client.get('/c3/capacity')).status_code == 404
+
+    run_against_fake(monkeypatch, ['c1', 'c2', 'c3'], scenario)
+
+
+def test_capacity_does_not_wait_for_precompute(app, monkeypatch):
+    async def scenario(client, fake):
+        gate = asyncio.Event()
+
+        async def blocked(campaign_id):
+            await gate.wait()
+            return b'{}'
+
+        precomputer = Precomputer(start.result_cache, workers=1, max_pending=8, jobs=dict(
+            returns=(start.default_returns_key, blocked),
+            analytics=(start.default_analytics_key, blocked),
+        ))
+        monkeypatch.setattr(start, 'precomputer', precomputer)
+        await client.post('/precompute/c1')
+        await asyncio.sleep(0)
+        assert precomputer.status('c1')['status'] == 'running'
+
+        response = await asyncio.wait_for(client.get('/c1/capacity'), timeout=10)
+        assert response.status_code == 200
+        assert precomputer.status('c1')['status'] == 'running'
+        assert start.result_cache.size == 0
+        gate.set()
+
+    run_against_fake(monkeypatch, ['c1'], scenario)
@@ -0,0 +1,84 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import orjson
+import pandas as pd
+
+import utils
+from capacity import price_volume_matrices
+from fake_stratifyx import FakeStratifyX
+
+
+def test_parse_market_data_blob_builds_typed_columns():
+    blob = orjson.dumps([
+        {'t': '2024-01-02T14:30:00', 'c': 2.5, 'v': 100, 'symbol': 'AAPL'},
+        {'t': '2024-01-02T14:31:00', 'c': None, 'v': 200, 'symbol': 'AAPL'},
+    ])
+    bars = utils.parse_market_data_blob(blob)
+    assert list(bars.columns) == ['c', 'v']
+    assert (bars.dtypes == np.float64).all()
+    assert np.isnan(bars['c'].iloc[1]) and bars['v'].iloc[1] == 200
+    assert bars.index.name == 't' and str(bars.index[0]) == '2024-01-02 14:30:00'
+    assert utils.market_data_rows({'AAPL': blob}) == 2
+
+
+def test_null_or_missing_fields_in_the_first_bar_keep_their_columns():
+    blob = orjson.dumps([
+        {'t': '2024-01-02T14:30:00', 'c': None},
+        {'t': '2024-01-02T14:31:00', 'c': 2.5, 'h': 2.6},
+    ])
+    bars = utils.parse_market_data_blob(blob)
+    assert list(bars.columns) == ['c', 'h', 'v']
+    assert np.isnan(bars['c'].iloc[0]) and bars['c'].iloc[1] == 2.5
+    assert np.isnan(bars['h'].iloc[0]) and bars['v'].isna().all()
+
+    price, volume = price_volume_matrices(utils.parse_market_data({'AAPL': blob}))
+    assert price['AAPL'].iloc[1] == 2.5 and volume['AAPL'].isna().all()
+
+
+def test_empty_blobs_are_skipped():
+    empty = utils.parse_market_data_blob(b'[]')
+    assert empty.empty and list(empty.columns) == ['c', 'v']
+
+    blob = orjson.dumps([{'t': '2024-01-02T14:30:00', 'c': 2.5, 'v': 100}])
+    market_data = utils.parse_market_data({'AAPL': blob, 'MSFT': b'[]'})
+    assert list(market_data) == ['AAPL']
+    price, volume = price_volume_matrices(market_data)
+    assert list(price.columns) == ['AAPL'] and volume['AAPL'].iloc[0] == 100
+
+
+def test_parse_timestamps_matches_pandas():
+    naive = ['2024-01-02T14:30:00.000', '2024-01-02T14:31:00.250']
+    assert utils.parse_timestamps(naive).equals(pd.to_datetime(naive))
+    offsets = ['2024-01-02T14:30:00+00:00', '2024-01-02T09:31:00-05:00']
+    assert utils.parse_timestamps(offsets).equals(pd.to_datetime(offsets, utc=True))
+    assert utils.parse_timestamps(['Jan 2, 2024']).equals(pd.to_datetime(['Jan 2, 2024']))
+
+
+def test_parse_market_data_in_worker_processes():
+    blobs = {ticker: orjson.dumps([{'t': f'2024-01-02T14:3{i}:00', 'c': 1.0 + i, 'v': 10 * i} for i in range(5)])
+             for ticker in ('AAPL', 'MSFT', 'GOOG')}
+    inline = utils.parse_market_data(blobs)
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pooled = utils.parse_market_data(blobs, pool)
+    assert list(pooled) == list(blobs)
+    for ticker in blobs:
+        pd.testing.assert_frame_equal(pooled[ticker], inline[ticker])
+
+
+def test_market_data_blobs_are_filtered_by_timeframe():
+    async def main():
+        fake = await FakeStratifyX(['c1']).start()
+        try:
+            daily = await utils.async_get_market_data_blobs('1D', fake.url, 'c1')
+            minute = await utils.async_get_market_data_blobs('1T', fake.url, 'c1')
+        finally:
+            await fake.stop()
+        assert set(daily) == set(minute) == {'AAPL', 'MSFT'}
+        assert isinstance(daily['AAPL'], bytes)
+        assert len(utils.parse_market_data_blob(daily['AAPL'])) > 100
+        assert len(utils.parse_market_data_blob(minute['AAPL'])) == 30
+
+    asyncio.run(main())
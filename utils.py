@@ -1,11 +1,14 @@
+import asyncio
 import msgpack
 import numpy as np
 import aiohttp
 import logging
+import orjson
 import pandas as pd
-from io import StringIO
 import pyfolio as pf
+import warnings
 import yaml
+from operator import itemgetter
 
 
 async def async_get_campaign(server, campaign_id):
@@ -21,11 +24,13 @@ async def async_get_campaign(server, campaign_id):
     return None
 
 
-async def async_parse_req(server, campaign_id, key):
+async def async_parse_req(server, campaign_id, key, on_size=None):
     try:
         async with aiohttp.ClientSession() as session:
             async with session.get(f"{server}/{campaign_id}/{key}") as response:
                 response.raise_for_status()
+                if on_size is not None:
+                    await on_size(response.content_length)
                 msg_pack_data = msgpack.unpackb(await response.read())
 
                 d = pd.DataFrame([{'t': row['t'], **row['data']} for row in msg_pack_data]).set_index('t')
@@ -39,19 +44,79 @@ async def async_parse_req(server, campaign_id, key):
         logging.error(f"Unexpected error: {e}")
 
 
-async def parse_market_data_req(base_tf, server, campaign_id):
+def parse_timestamps(values):
+    # numpy's ISO 8601 parser is several times faster than pd.to_datetime on a list of strings; it converts UTC
+    # offsets itself (with a warning), so those come back as UTC, and anything it cannot read goes through pandas
+    try:
+        with warnings.catch_warnings(record=True) as offsets:
+            warnings.simplefilter('always')
+            index = pd.DatetimeIndex(np.array(values, dtype='datetime64[ns]'))
+    except ValueError:
+        return pd.to_datetime(values)
+    return index.tz_localize('utc') if offsets else index
+
+
+MARKET_DATA_FIELDS = ('c', 'v')
+
+
+def _column(records, field):
+    try:
+        return np.fromiter(map(itemgetter(field), records), np.float64, len(records))
+    except (KeyError, TypeError):
+        # some bar is missing the field or has it null
+        return np.array([record.get(field) for record in records], dtype=np.float64)
+
+
+def parse_market_data_blob(blob):
+    # one typed float64 column per numeric field found in any bar; close and volume are always there, all NaN if
+    # no bar carries them, so a null or short first bar cannot drop a column
+    records = orjson.loads(blob)
+    fields = [*records[0], *sorted(set().union(*records) - records[0].keys())] if records else []
+    columns = {}
+    for field in fields:
+        if field == 't':
+            continue
+        try:
+            columns[field] = _column(records, field)
+        except ValueError:
+            # not numeric, e.g. a symbol
+            continue
+    for field in MARKET_DATA_FIELDS:
+        if field not in columns:
+            columns[field] = np.full(len(records), np.nan)
+    d = pd.DataFrame(columns, index=parse_timestamps(list(map(itemgetter('t'), records))))
+    d.index.name = 't'
+    return d
+
+
+def parse_market_data(blobs, pool=None):
+    # orjson holds the GIL while it builds the bars, so assets are only parsed side by side in separate processes;
+    # assets without a single bar are left out
+    if pool is None or len(blobs) < 2:
+        parsed = map(parse_market_data_blob, blobs.values())
+    else:
+        parsed = pool.map(parse_market_data_blob, blobs.values())
+    return {ticker: bars for ticker, bars in zip(blobs, parsed) if len(bars)}
+
+
+def market_data_rows(blobs):
+    # every bar is one flat JSON object, so counting braces gives the row count without decoding
+    return sum(blob.count(b'{') for blob in blobs.values())
+
+
+async def async_get_market_data_blobs(base_tf, server, campaign_id, on_size=None):
     try:
         async with aiohttp.ClientSession() as session:
             async with session.get(f"{server}/{campaign_id}/market_data") as response:
                 response.raise_for_status()
-                msg_pack_data = msgpack.unpackb(await response.read())
-
-                data = {ele['data']['asset']['ticker']: pd.read_json(StringIO(ele['data']['dataBlob']),
-                                                                     orient='records').set_index('t')
-                        for ele in msg_pack_data if ele['data']['timeframe'] == base_tf}
-                for key in data:
-                    data[key].index = pd.to_datetime(data[key].index)
-                return data
+                if on_size is not None:
+                    await on_size(response.content_length)
+                # raw=True leaves every string as bytes, so blobs of other timeframes are never utf-8 decoded
+                msg_pack_data = msgpack.unpackb(await response.read(), raw=True)
+
+        timeframe = base_tf.encode()
+        return {ele[b'data'][b'asset'][b'ticker'].decode(): ele[b'data'][b'dataBlob']
+                for ele in msg_pack_data if ele[b'data'][b'timeframe'] == timeframe}
     except aiohttp.ClientError as e:
         logging.error(f"Request failed: {e}")
     except Exception as e:
@@ -77,10 +142,11 @@ def get_returns(account, base_tf, factor_returns):
     return pf.utils.clip_returns_to_benchmark(returns, factor_returns)
 
 
-async def async_get_benchmark_returns(period, benchmark):
+async def async_get_benchmark_returns(period, benchmark, benchmark_url):
     start = pd.to_datetime(period['start'])
     end = pd.to_datetime(period['end'])
-    benchmark = pd.read_parquet(f's3://epoch-db/DailyBars/Stocks/{benchmark}.parquet.gzip', index='t')
+    # read_parquet blocks for the whole download; keep it off the event loop
+    benchmark = await asyncio.to_thread(pd.read_parquet, benchmark_url.format(benchmark=benchmark), index='t')
     benchmark = benchmark[((benchmark.index >= start) & (benchmark.index <= end))]
     benchmark.index = pd.to_datetime(benchmark.index, utc=True)
     benchmark.name = 'benchmark_returns'